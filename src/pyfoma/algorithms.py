@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 """Defines common algorithms over FSTs"""
-from pyfoma.fst import FST, State, Transition
+from pyfoma.fst import FST, State, Transition, _unwind_output, _INF
 import pyfoma.private.partition_refinement as partition_refinement
 from pyfoma.eliminate_flags import eliminate_fst_flags
 
@@ -131,9 +131,10 @@ def scc(fst: 'FST') -> set:
         for target in targets:
             if target not in indices:
                 _strongconnect(target)
-                lowlink[state] = min(lowlink[state], lowlink[target])
-            elif target in onstack:
-                lowlink[state] = min(lowlink[state], indices[target])
+                if lowlink[target] < lowlink[state]:
+                    lowlink[state] = lowlink[target]
+            elif target in onstack and indices[target] < lowlink[state]:
+                lowlink[state] = indices[target]
         if lowlink[state] == indices[state]:
             currscc = set()
             while True:
@@ -198,12 +199,12 @@ def epsilon_removed(fst: 'FST') -> 'FST':
     eclosures = {s:epsilon_closure(fst, s) for s in fst.states}
     if all(len(ec) == 0 for ec in eclosures.values()): # bail, no epsilon transitions
         return fst.__copy__()
-    newfst, mapping = fst.copy_filtered(labelfilter = lambda lbl: any(len(sublabel) != 0 for sublabel in lbl))
+    newfst, mapping = fst.copy_filtered(labelfilter = lambda lbl: lbl.count('') != len(lbl))
     for state, ec in eclosures.items():
         for target, cost in ec.items():
             # copy target's transitions to source
             for label, t in target.all_transitions():
-                if all(len(sublabel) == 0 for sublabel in label): # is epsilon: skip
+                if label.count('') == len(label): # is epsilon: skip
                     continue
                 mapping[state].add_transition(mapping[t.targetstate], label, cost + t.weight)
             if target in fst.finalstates:
@@ -243,7 +244,7 @@ def dijkstra(fst: 'FST', state) -> float:
         for trgt, cost in s.all_targets_cheapest().items():
             if trgt not in explored:
                 heapq.heappush(Q, (cost + w, next(cntr), trgt))
-    return float("inf")
+    return _INF
 
 
 @_copy_param
@@ -273,16 +274,16 @@ def words_nbest(fst: 'FST', n) -> list:
 def words_cheapest(fst: 'FST'):
     """A generator to yield all words in order of cost, cheapest first."""
     cntr = itertools.count()
-    Q = [(0.0, next(cntr), fst.initialstate, [])]
+    Q = [(0.0, next(cntr), fst.initialstate, None)]
     while Q:
         cost, _, s, seq = heapq.heappop(Q)
         if s is None:
-            yield cost, seq
+            yield cost, _unwind_output(seq)
         else:
             if s in fst.finalstates:
                 heapq.heappush(Q, (cost + s.finalweight, next(cntr), None, seq))
             for label, t in s.all_transitions():
-                heapq.heappush(Q, (cost + t.weight, next(cntr), t.targetstate, seq + [label]))
+                heapq.heappush(Q, (cost + t.weight, next(cntr), t.targetstate, (seq, label)))
 
 
 @_copy_param
@@ -585,6 +586,7 @@ def inverted(fst: 'FST') -> 'FST':
             for t in tr:
                 t.label = t.label[::-1]
         s.transitions = {lbl[::-1]:tr for lbl, tr in s.transitions.items()}
+        s._invalidate()
     return fst
 
 
@@ -659,6 +661,7 @@ def projected(fst: 'FST', dim = 0) -> 'FST':
                 t.label = lbl[sl]
                 newalphabet |= {sublabel for sublabel in lbl[sl]}
         s.transitions = newtransitions
+        s._invalidate()
     if '.' not in newalphabet: # Preserve . semantics if it occurs on the tape we extract
         fst.alphabet = newalphabet
     return fst
@@ -749,7 +752,7 @@ def product(fst1: 'FST', fst2: 'FST', finalf = any, oplus = min, pathfollow = la
     newfst = FST()
     Q = deque([(fst1.initialstate, fst2.initialstate)])
     S = {(fst1.initialstate, fst2.initialstate): newfst.initialstate}
-    dead1, dead2 = State(finalweight = float("inf")), State(finalweight = float("inf"))
+    dead1, dead2 = State(finalweight = _INF), State(finalweight = _INF)
     while Q:
         t1s, t2s = Q.pop()
         currentstate = S[(t1s, t2s)]
@@ -759,8 +762,8 @@ def product(fst1: 'FST', fst2: 'FST', finalf = any, oplus = min, pathfollow = la
             currentstate.finalweight = oplus(t1s.finalweight, t2s.finalweight)
         # Get all outgoing labels we want to follow
         for lbl in pathfollow(t1s.transitions.keys(), t2s.transitions.keys()):
-            for outtr in t1s.transitions.get(lbl, (Transition(dead1, lbl, float('inf')), )):
-                for intr in t2s.transitions.get(lbl, (Transition(dead2, lbl, float('inf')), )):
+            for outtr in t1s.transitions.get(lbl, (Transition(dead1, lbl, _INF), )):
+                for intr in t2s.transitions.get(lbl, (Transition(dead2, lbl, _INF), )):
                     if (outtr.targetstate, intr.targetstate) not in S:
                         Q.append((outtr.targetstate, intr.targetstate))
                         S[(outtr.targetstate, intr.targetstate)] = State()
@@ -2,23 +2,47 @@
 
 """PyFoma Finite-State Tool."""
 
-import heapq, json, itertools, re as pyre
+import heapq, json, itertools, functools, re as pyre
+from array import array
 from collections import deque, defaultdict
-from typing import Callable, Dict, Any, Iterable, TextIO
+from typing import Callable, Dict, Any, FrozenSet
 from os import PathLike
 from pathlib import Path
 from pyfoma.flag import FlagStringFilter, FlagOp
 import subprocess
+import sys
+import os
+import tempfile
+import base64
 import pickle
+import hashlib
+try:
+    import orjson
+except ImportError:  # Optional, only makes tojs() faster
+    orjson = None
+
+# Number of lines to accumulate before writing them to a file
+_WRITE_BATCH = 65536
+# Identifies the contents of files written by FST.save
+_SAVE_FORMAT = "pyfoma-csr-1"
+# Pickle protocol of files written by FST.save (5 cannot be read before Python 3.8)
+_SAVE_PROTOCOL = 4
+# Number of tokenized words to remember per alphabet
+_TOKENIZE_CACHE_SIZE = 4096
+# Weight of a missing path or a non-final state
+_INF = float("inf")
+# Separates input and output symbols in todict() labels
+_LABEL_SPLIT_RE = pyre.compile(r"(?<!\\)\|")
 
 
 def re(*args, **kwargs):
     return FST.re(*args, **kwargs)
 
 
-def _multichar_matcher(multichar_symbols: Iterable[str]) -> pyre.Pattern:
+@functools.lru_cache(maxsize=128)
+def _multichar_matcher(multichar_symbols: FrozenSet[str]) -> pyre.Pattern:
     """Create matcher for unquoted multichar symbols in lexicons and
-    regular expressions."""
+    regular expressions.  Cached, so pass a frozenset."""
     ordered = [sym for sym in multichar_symbols if len(sym) > 1]
     ordered.sort(key=len, reverse=True)
     return pyre.compile(
@@ -35,6 +59,144 @@ def _multichar_replacer(matchobj: pyre.Match):
     return "'" + sym.replace("'", r"\'") + "'"
 
 
+def _rlg_tokenize(w: str, escaper: pyre.Pattern = None) -> list:
+    """Split a lexicon entry into symbols, where unescaped spaces
+    (used for alignment) become epsilons."""
+    if w == '':
+        return ['']
+    if escaper is not None:
+        w = escaper.sub(_multichar_replacer, w)
+    tokens = []
+    tok_re = r"'(?P<multi>'|(?:\\'|[^'])*)'|\\(?P<esc>(.))|(?P<single>(.))"
+    for mo in pyre.finditer(tok_re, w):
+        token = mo.group(mo.lastgroup)
+        if token == " " and mo.lastgroup == 'single':
+            token = ""  # normal spaces for alignment, escaped for actual
+        elif mo.lastgroup == "multi":
+            token = token.replace(r"\'", "'")
+        tokens.append(token)
+    return tokens
+
+
+def _unwind_output(output: tuple) -> list:
+    """Turn a linked output (previous, symbol) into a list of symbols."""
+    syms = []
+    while output is not None:
+        output, sym = output
+        syms.append(sym)
+    syms.reverse()
+    return syms
+
+
+def _dumps_json(obj) -> str:
+    """Encode to compact JSON, with orjson if it is installed (both
+    encoders produce the same output)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _utf16_len(s: str) -> int:
+    """Length of a string in UTF-16 code units, as Javascript counts
+    it.  Characters outside the BMP take two."""
+    return len(s) + sum(ord(c) > 0xFFFF for c in s)
+
+
+class _AlphabetIndex:
+    """Lookup structures for an alphabet, shared by the FSTs that have
+    it: a character trie of its symbols, where the key None marks the
+    end of a symbol, the most recent tokenizations of words, and a
+    filter for its flag diacritics."""
+    __slots__ = ['trie', 'tokenized', 'flag_filter']
+    def __init__(self, alphabet: FrozenSet[str]):
+        self.flag_filter = FlagStringFilter(alphabet)
+        self.tokenized = {}
+        self.trie = {}
+        for sym in alphabet:
+            node = self.trie
+            for c in sym:
+                node = node.setdefault(c, {})
+            node[None] = True
+
+
+@functools.lru_cache(maxsize=128)
+def _index_alphabet(alphabet: FrozenSet[str]) -> _AlphabetIndex:
+    """Index an alphabet, reusing the index of an equal one."""
+    return _AlphabetIndex(alphabet)
+
+
+def _tokenize(index: _AlphabetIndex, word: str) -> tuple:
+    """Tokenize a string into the longest symbols of an alphabet.
+    Remembered per alphabet, so that a word run through several FSTs
+    sharing an alphabet is only tokenized once."""
+    tokens = index.tokenized.get(word)
+    if tokens is not None:
+        return tokens
+    trie = index.trie
+    tokens = []
+    start = 0
+    while start < len(word):
+        end = start + 1  # Default is length 1 token unless we find a longer one
+        node = trie
+        for pos in range(start, len(word)):
+            node = node.get(word[pos])
+            if node is None:
+                break
+            if None in node:  # Longest symbol in alphabet so far
+                end = pos + 1
+        tokens.append(word[start:end])
+        start = end
+    if len(index.tokenized) >= _TOKENIZE_CACHE_SIZE:
+        index.tokenized.clear()  # Simpler than LRU, and cheap to refill
+    tokens = index.tokenized[word] = tuple(tokens)
+    return tokens
+
+
+def _compile_regex(regularexpression: str, defined: dict, functions: set,
+                   multichar_symbols: FrozenSet[str] = None) -> 'FST':
+    """Compile a regular expression, going through the on-disk cache
+    if FST.regex_cache_dir is set.  Defined FSTs are identified by
+    their contents, but functions only by their names."""
+    import pyfoma.private.regexparse as regexparse
+    path = None
+    if FST.regex_cache_dir is not None:
+        from pyfoma import __version__
+        key = repr((__version__, regularexpression,
+                    sorted((name, str(fst), sorted(fst.alphabet)) for name, fst in defined.items()),
+                    sorted(f"{f.__module__}.{f.__qualname__}" for f in functions),
+                    sorted(multichar_symbols or ())))
+        path = Path(FST.regex_cache_dir) / hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        if path.with_suffix('.fst').exists():
+            try:
+                return FST.load(str(path))
+            except Exception:  # Damaged file, treat it as missing
+                pass
+    if multichar_symbols is not None:
+        escaper = _multichar_matcher(multichar_symbols)
+        regularexpression = escaper.sub(_multichar_replacer, regularexpression)
+    compiled = regexparse.RegexParse(regularexpression, defined, functions).compiled
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Save to a temporary file and rename it, so that a partly
+        # written file is never loaded (e.g. by another process)
+        fd, temppath = tempfile.mkstemp(suffix='.fst', dir=path.parent)
+        os.close(fd)
+        try:
+            compiled.save(temppath)
+            os.replace(temppath, path.with_suffix('.fst'))
+        finally:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+    return compiled
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_regex_cached(regularexpression: str, multichar_symbols: FrozenSet[str] = None) -> 'FST':
+    """Compile a regular expression which uses no defined FSTs or
+    functions, remembering the most recent ones."""
+    return _compile_regex(regularexpression, {}, set(), multichar_symbols)
+
+
 # TODO: Move all algorithm functions to the algorithms module
 class FST:
 
@@ -90,16 +252,13 @@ class FST:
         newfst.states.add(secondstate)
         newfst.finalstates = {secondstate}
         secondstate.finalweight = 0.0
-        alphabet = set()
-        for start, end in ranges:
-            for symbol in range(start, end + 1):
-                if symbol not in alphabet:
-                    alphabet |= {chr(symbol)}
-                    if not complement:
-                        newfst.initialstate.add_transition(secondstate, (chr(symbol),), 0.0)
+        alphabet = {chr(symbol) for start, end in ranges for symbol in range(start, end + 1)}
         if complement:
             newfst.initialstate.add_transition(secondstate, ('.',), 0.0)
             alphabet.add('.')
+        else:  # Fill in the transitions directly, add_transition is slow for large ranges
+            newfst.initialstate.transitions = {(sym,): {Transition(secondstate, (sym,), 0.0)}
+                                               for sym in alphabet}
         newfst.alphabet = alphabet
         return newfst
 
@@ -112,43 +271,50 @@ class FST:
            functions -- a set of Python functions that the compiler can access when a function
                        is referenced in the regex, e.g. $^myfunc(...)
         """
-        import pyfoma.private.regexparse as regexparse
         if multichar_symbols is not None:
-            escaper = _multichar_matcher(multichar_symbols)
-            regularexpression = escaper.sub(_multichar_replacer, regularexpression)
-        myregex = regexparse.RegexParse(regularexpression, defined, functions)
-        return myregex.compiled
+            multichar_symbols = frozenset(multichar_symbols)
+        if not defined and not functions:
+            # FSTs are mutable so the cached one is never handed out
+            return _compile_regex_cached(regularexpression, multichar_symbols).__copy__()
+        return _compile_regex(regularexpression, defined, functions, multichar_symbols)
 
     re = regex
 
+    regex_cache_dir = None
+    """If set to a directory, compiled regular expressions are saved there and reused across sessions"""
+
     @classmethod
     def from_strings(cls, strings, multichar_symbols=None):
         """Create an automaton that accepts words in the iterable 'strings'."""
-        Grammar = {"Start": ((w, "#") for w in strings)}
-        lex = FST.rlg(Grammar, "Start", multichar_symbols=multichar_symbols)
-        return lex.determinize_as_dfa().minimize().label_states_topology()
+        escaper = None
+        if multichar_symbols is not None:
+            escaper = _multichar_matcher(frozenset(multichar_symbols))
+        # A trie of the words is already deterministic, so just minimize it
+        lex = FST(alphabet = set())
+        for w in strings:
+            currstate = lex.initialstate
+            for sym in _rlg_tokenize(w, escaper):
+                if sym == '':
+                    continue
+                lex.alphabet.add(sym)
+                transitions = currstate.transitions.get((sym,))
+                if transitions:
+                    currstate = next(iter(transitions)).targetstate
+                else:
+                    targetstate = State()
+                    lex.states.add(targetstate)
+                    currstate.add_transition(targetstate, (sym,), 0.0)
+                    currstate = targetstate
+            lex.finalstates.add(currstate)
+            currstate.finalweight = 0.0
+        return lex.minimize().label_states_topology()
 
     @classmethod
     def rlg(cls, grammar, startsymbol, multichar_symbols=None):
         """Compile a (weighted) right-linear grammar into an FST, similarly to lexc."""
         escaper = None
         if multichar_symbols is not None:
-            escaper = _multichar_matcher(multichar_symbols)
-        def _rlg_tokenize(w):
-            if w == '':
-                return ['']
-            if escaper is not None:
-                w = escaper.sub(_multichar_replacer, w)
-            tokens = []
-            tok_re = r"'(?P<multi>'|(?:\\'|[^'])*)'|\\(?P<esc>(.))|(?P<single>(.))"
-            for mo in pyre.finditer(tok_re, w):
-                token = mo.group(mo.lastgroup)
-                if token == " " and mo.lastgroup == 'single':
-                    token = ""  # normal spaces for alignment, escaped for actual
-                elif mo.lastgroup == "multi":
-                    token = token.replace(r"\'", "'")
-                tokens.append(token)
-            return tokens
+            escaper = _multichar_matcher(frozenset(multichar_symbols))
 
         newfst = FST(alphabet = set())
         statedict = {name:State(name = name) for name in grammar.keys() | {"#"}}
@@ -162,15 +328,18 @@ class FST:
                 currstate = statedict[lexstate]
                 lhs = (rule[0],) if isinstance(rule[0], str) else rule[0]
                 target = rule[1]
-                i = _rlg_tokenize(lhs[0])
-                o = i if len(lhs) == 1 else _rlg_tokenize(lhs[1])
+                i = _rlg_tokenize(lhs[0], escaper)
+                o = i if len(lhs) == 1 else _rlg_tokenize(lhs[1], escaper)
                 newfst.alphabet |= {sym for sym in i + o if sym != ''}
-                for ii, oo, idx in itertools.zip_longest(i, o, range(max(len(i), len(o))),
-                    fillvalue = ''):
+                last = max(len(i), len(o)) - 1
+                weight = 0.0 if len(rule) < 3 else float(rule[2])
+                for idx in range(last + 1):
+                    ii = i[idx] if idx < len(i) else ''
+                    oo = o[idx] if idx < len(o) else ''
                     w = 0.0
-                    if idx == max(len(i), len(o)) - 1:  # dump weight on last transition
+                    if idx == last:  # dump weight on last transition
                         targetstate = statedict[target] # before reaching another lexstate
-                        w = 0.0 if len(rule) < 3 else float(rule[2])
+                        w = weight
                     else:
                         targetstate = State()
                         newfst.states.add(targetstate)
@@ -189,8 +358,12 @@ class FST:
         """
         if not path.endswith('.fst'):
             path = path + '.fst'
+        # Save the arrays of a snapshot rather than the State objects
+        csr = _CSR(self)
         with open(path, 'wb') as f:
-            pickle.dump(self, f)
+            pickle.dump((_SAVE_FORMAT, self.alphabet, [s.name for s in csr.states],
+                         csr.indptr, csr.tgt, csr.label, csr.weight, csr.labels,
+                         csr.final, csr.finalweight), f, protocol=_SAVE_PROTOCOL)
 
     @classmethod
     def load(cls, path: str) -> 'FST':
@@ -202,6 +375,21 @@ class FST:
             path = path + '.fst'
         with open(path, 'rb') as f:
             fst = pickle.load(f)
+        if isinstance(fst, FST):  # Saved by an older version
+            return fst
+        _, alphabet, names, indptr, tgt, label, weight, labels, final, finalweight = fst
+        states = [State(name = name) for name in names]
+        for src, s in enumerate(states):
+            for arc in range(indptr[src], indptr[src + 1]):
+                lbl = labels[label[arc]]
+                s.transitions.setdefault(lbl, set()).add(Transition(states[tgt[arc]], lbl, weight[arc]))
+        fst = FST(alphabet = alphabet)
+        fst.initialstate = states[0]
+        fst.states = set(states)
+        for s, isfinal, finalweight in zip(states, final, finalweight):
+            if isfinal:
+                fst.finalstates.add(s)
+                s.finalweight = finalweight
         return fst
 
     def save_att(self, base: PathLike, state_symbols=False, epsilon="@0@"):
@@ -232,71 +420,44 @@ class FST:
         ssympath = path.with_suffix(".ssyms")
         isympath = path.with_suffix(".isyms")
         osympath = path.with_suffix(".osyms")
-        # Number all states and create state symbol table
-        if state_symbols:
-            ssyms = [self.initialstate.name]
-        else:
-            ssyms = ["0"]
-        ssymtab = {id(self.initialstate): ssyms[0]}
-        for s in self.states:
-            if s == self.initialstate:
-                continue
-            if s.name is None or not state_symbols:
-                name = str(len(ssyms))
-            else:
-                name = s.name
-            ssymtab[id(s)] = name
-            ssyms.append(name)
+        csr = _CSR(self)
+        # Create state symbol table (state numbers are already assigned)
         if state_symbols:
+            ssyms = [str(idx) if s.name is None else s.name
+                     for idx, s in enumerate(csr.states)]
             with open(ssympath, "wt") as outfh:
-                for idx, name in enumerate(ssyms):
-                    print(f"{name}\t{idx}", file=outfh)
-        # Do a second pass to output the FST itself (we will always have
-        # to do this because of the need to number states)
-        isyms = {epsilon: 0}
-        osyms = {epsilon: 0}
-
-        def output_state(s: State, outfh: TextIO):
-            name = ssymtab[id(s)]
-            for label, arcs in s.transitions.items():
-                if len(label) == 1:
-                    isym = osym = (label[0] or epsilon)
-                else:
-                    isym, osym = ((x or epsilon) for x in label)
-                if isym not in isyms:
-                    isyms[isym] = len(isyms)
-                if osym not in osyms:
-                    osyms[osym] = len(osyms)
-                for transition in arcs:
-                    dest = ssymtab[id(transition.targetstate)]
-                    fields = [
-                        name,
-                        dest,
-                        isym,
-                        osym,
-                    ]
-                    if transition.weight != 0.0:
-                        fields.append(transition.weight)
-                    print("\t".join(fields), file=outfh)
-            # NOTE: These are not required to be at the end of the file
-            if s in self.finalstates:
-                name = ssymtab[id(s)]
-                if s.finalweight != 0.0:
-                    print(f"{name}\t{s.finalweight}", file=outfh)
-                else:
-                    print(name, file=outfh)
-
-        with open(path, "wt") as outfh:
-            output_state(self.initialstate, outfh)
-            for s in self.states:
-                if s != self.initialstate:
-                    output_state(s, outfh)
-        with open(isympath, "wt") as outfh:
-            for name, idx in isyms.items():
-                print(f"{name}\t{idx}", file=outfh)
-        with open(osympath, "wt") as outfh:
-            for name, idx in osyms.items():
-                print(f"{name}\t{idx}", file=outfh)
+                outfh.write("".join(f"{name}\t{idx}\n" for idx, name in enumerate(ssyms)))
+        else:
+            ssyms = [str(idx) for idx in range(len(csr.states))]
+        # Symbol 0 is always epsilon, as required by OpenFST
+        syms = [epsilon] + csr.syms[1:]
+        # Symbol fields of each label, shared by all of its arcs
+        labelsyms = [f"{syms[i]}\t{syms[o]}" for i, o in zip(csr.label_isym, csr.label_osym)]
+
+        with open(path, "wt", buffering=1 << 20) as outfh:
+            # Write lines in batches rather than one at a time
+            rows = []
+            for src, name in enumerate(ssyms):
+                for arc in range(csr.indptr[src], csr.indptr[src + 1]):
+                    weight = csr.weight[arc]
+                    if weight != 0.0:
+                        rows.append(f"{name}\t{ssyms[csr.tgt[arc]]}\t{labelsyms[csr.label[arc]]}\t{weight}\n")
+                    else:
+                        rows.append(f"{name}\t{ssyms[csr.tgt[arc]]}\t{labelsyms[csr.label[arc]]}\n")
+                # NOTE: These are not required to be at the end of the file
+                if csr.final[src]:
+                    if csr.finalweight[src] != 0.0:
+                        rows.append(f"{name}\t{csr.finalweight[src]}\n")
+                    else:
+                        rows.append(f"{name}\n")
+                if len(rows) >= _WRITE_BATCH:
+                    outfh.write("".join(rows))
+                    rows.clear()
+            outfh.write("".join(rows))
+        # Input and output symbols share the same table
+        for sympath in isympath, osympath:
+            with open(sympath, "wt") as outfh:
+                outfh.write("".join(f"{name}\t{idx}\n" for idx, name in enumerate(syms)))
     # endregion
 
 
@@ -306,34 +467,33 @@ class FST:
         """Copy an FST. Actually calls copy_filtered()."""
         return self.copy_filtered()[0]
 
+    def __getstate__(self):
+        """Pickle an FST, leaving out the alphabet index (which is
+        rebuilt when needed)."""
+        state = self.__dict__.copy()
+        state.pop('_alphabetcache', None)
+        return state
+
     def __len__(self):
         """Return the number of states."""
         return len(self.states)
 
     def __str__(self):
         """Generate an AT&T string representing the FST."""
-        # Number states arbitrarily based on id()
-        ids = [id(s) for s in self.states if s != self.initialstate]
-        statenums = {ids[i]:i+1 for i in range(len(ids))}
-        statenums[id(self.initialstate)] = 0 # The initial state is always 0
-        st = ""
-        for s in self.states:
-            if len(s.transitions) > 0:
-                for label in s.transitions.keys():
-                    if len(label) == 1:
-                        att_label = (label[0], label[0])
-                    else:
-                        att_label = label
-                    # You get Foma's default here since it cannot be configured
-                    att_label = ["@0@" if sym == "" else sym for sym in att_label]
-                    for transition in s.transitions[label]:
-                        st += '{}\t{}\t{}\t{}\n'.format(statenums[id(s)],\
-                        statenums[id(transition.targetstate)], '\t'.join(att_label),\
-                        transition.weight)
-        for s in self.states:
-            if s in self.finalstates:
-                st += '{}\t{}\n'.format(statenums[id(s)], s.finalweight)
-        return st
+        # The initial state is always 0
+        csr = _CSR(self)
+        # You get Foma's default here since it cannot be configured
+        att_labels = ['\t'.join("@0@" if sym == "" else sym
+                                for sym in (label * 2 if len(label) == 1 else label))
+                      for label in csr.labels]
+        rows = []
+        for src in range(len(csr.states)):
+            for arc in range(csr.indptr[src], csr.indptr[src + 1]):
+                rows.append(f"{src}\t{csr.tgt[arc]}\t{att_labels[csr.label[arc]]}\t{csr.weight[arc]}\n")
+        for src in range(len(csr.states)):
+            if csr.final[src]:
+                rows.append(f"{src}\t{csr.finalweight[src]}\n")
+        return "".join(rows)
 
     def __and__(self, other):
         """Intersection."""
@@ -374,17 +534,24 @@ class FST:
 
     def cleanup_sigma(self):
         """Remove symbols if they are no longer needed, including . ."""
-        seen = {sym for _, lbl, _ in self.all_transitions(self.states) for sym in lbl}
+        # Only the distinct labels of each state matter, not every arc
+        seen = {sym for s in self.states for lbl in s.transitions for sym in lbl}
         if '.' not in seen:
             self.alphabet &= seen
         return self
 
+    _graphviz_installed = False
+    """Whether the Graphviz executable was found (we keep looking until it is)"""
+
     def check_graphviz_installed(self):
+        if FST._graphviz_installed:
+            return True
         try:
             subprocess.run(["dot", "-V"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return True
         except (subprocess.CalledProcessError, FileNotFoundError):
             return False
+        FST._graphviz_installed = True
+        return True
 
     def view(self, raw=False, show_weights=False, show_alphabet=True) -> 'graphviz.Digraph':
         """Creates a 'graphviz.Digraph' object to view the FST. Will automatically display the FST in Jupyter.
@@ -415,43 +582,41 @@ class FST:
         sigma = "&Sigma;: {" + ','.join(sorted(a for a in self.alphabet)) + "}" \
             if show_alphabet else ""
         g = graphviz.Digraph('FST', graph_attr={"label": sigma, "rankdir": "LR"})
-        statenums = self.number_unnamed_states()
+        csr = _CSR(self)
+        # Number unnamed states in the order of the snapshot
+        cntr = itertools.count()
+        statenums = [next(cntr) if s.name is None else s.name for s in csr.states]
         if show_weights == False:
-            if any(t.weight != 0.0 for _, _, t in self.all_transitions(self.states)) or \
+            if any(w != 0.0 for w in csr.weight) or \
                     any(s.finalweight != 0.0 for s in self.finalstates):
                 show_weights = True
+        nodelabels = [str(statenums[i]) + _float_format(s.finalweight) if csr.final[i]
+                      else str(statenums[i]) for i, s in enumerate(csr.states)]
 
         g.attr(rankdir='LR', size='8,5')
         g.attr('node', shape='doublecircle', style='filled')
-        for s in self.finalstates:
-            g.node(str(statenums[id(s)]) + _float_format(s.finalweight))
-            if s == self.initialstate:
-                g.node(str(statenums[id(s)]) + _float_format(s.finalweight), style='filled, bold')
+        for i, nodelabel in enumerate(nodelabels):
+            if csr.final[i]:
+                g.node(nodelabel)
+                if i == 0:  # initial state
+                    g.node(nodelabel, style='filled, bold')
 
         g.attr('node', shape='circle', style='filled')
-        for s in self.states:
-            if s not in self.finalstates:
-                g.node(str(statenums[id(s)]), shape='circle', style='filled')
-                if s == self.initialstate:
-                    g.node(str(statenums[id(s)]), shape='circle', style='filled, bold')
-            grouped_targets = defaultdict(set)  # {states}
-            for label, t in s.all_transitions():
-                grouped_targets[t.targetstate] |= {(t.targetstate, label, t.weight)}
-            for target, tlabelset in grouped_targets.items():
+        for src, sourcelabel in enumerate(nodelabels):
+            if not csr.final[src]:
+                g.node(sourcelabel, shape='circle', style='filled')
+                if src == 0:
+                    g.node(sourcelabel, shape='circle', style='filled, bold')
+            # Sort the arcs by target to group them into edges
+            arcs = sorted(range(csr.indptr[src], csr.indptr[src + 1]), key=csr.tgt.__getitem__)
+            for target, group in itertools.groupby(arcs, key=csr.tgt.__getitem__):
                 if raw == True:
-                    labellist = sorted((str(l) + '/' + str(w) for t, l, w in tlabelset))
-                else:
-                    labellist = sorted((':'.join(_str_fmt(label)) + _float_format(w) for _, label, w in tlabelset))
-                printlabel = ', '.join(labellist)
-                if s in self.finalstates:
-                    sourcelabel = str(statenums[id(s)]) + _float_format(s.finalweight)
-                else:
-                    sourcelabel = str(statenums[id(s)])
-                if target in self.finalstates:
-                    targetlabel = str(statenums[id(target)]) + _float_format(target.finalweight)
+                    labelset = {str(csr.labels[csr.label[arc]]) + '/' + str(csr.weight[arc]) for arc in group}
                 else:
-                    targetlabel = str(statenums[id(target)])
-                g.edge(sourcelabel, targetlabel, label=graphviz.nohtml(printlabel))
+                    labelset = {':'.join(_str_fmt(csr.labels[csr.label[arc]])) + _float_format(csr.weight[arc])
+                                for arc in group}
+                printlabel = ', '.join(sorted(labelset))
+                g.edge(sourcelabel, nodelabels[target], label=graphviz.nohtml(printlabel))
         return g
 
     def render(self, view=True, filename: str='FST', format='pdf'):
@@ -495,8 +660,13 @@ class FST:
         newfst.finalstates = {q1q2[s] for s in self.finalstates}
         newfst.initialstate = q1q2[self.initialstate]
 
-        for s, lbl, t in self.all_transitions(q1q2.keys()):
-            q1q2[s].add_transition(q1q2[t.targetstate], modlabel(lbl, t.weight), modweight(lbl, t.weight))
+        # Fill in the new transitions directly in a single pass
+        for s, newstate in q1q2.items():
+            for lbl, transitions in s.transitions.items():
+                for t in transitions:
+                    newlabel = modlabel(lbl, t.weight)
+                    newstate.transitions.setdefault(newlabel, set()).add(
+                        Transition(q1q2[t.targetstate], newlabel, modweight(lbl, t.weight)))
 
         for s in self.finalstates:
             q1q2[s].finalweight = s.finalweight
@@ -507,16 +677,17 @@ class FST:
         """Create a copy of self, possibly filtering out labels where them
            optional function 'labelfilter' returns False."""
         newfst = FST(alphabet = self.alphabet.copy())
-        q1q2 = {k:State() for k in self.states}
-        for s in self.states:
-            q1q2[s].name = s.name
+        q1q2 = {k:State(name = k.name) for k in self.states}
         newfst.states = set(q1q2.values())
         newfst.finalstates = {q1q2[s] for s in self.finalstates}
         newfst.initialstate = q1q2[self.initialstate]
 
-        for s, lbl, t in self.all_transitions(q1q2.keys()):
-            if labelfilter(lbl):
-                q1q2[s].add_transition(q1q2[t.targetstate], lbl, t.weight)
+        # Filter and copy the transitions one label at a time
+        for s, newstate in q1q2.items():
+            for lbl, transitions in s.transitions.items():
+                if labelfilter(lbl):
+                    newstate.transitions[lbl] = {Transition(q1q2[t.targetstate], lbl, t.weight)
+                                                 for t in transitions}
 
         for s in self.finalstates:
             q1q2[s].finalweight = s.finalweight
@@ -539,18 +710,39 @@ class FST:
            obey_flags toggles whether invalid flag diacritic
            combinations are filtered out. By default, flags are
            treated as epsilons in the input. print_flags toggels whether flag
-           diacritics are printed in the output. """
-        IN, OUT = [-1, 0] if inverse else [0, -1]  # Tuple positions for input, output
+           diacritics are printed in the output.
+           word may also be a list or tuple of symbols, as returned by
+           tokenize_against_alphabet, in which case it is used as is. """
+        IN, OUT = (-1, 0) if inverse else (0, -1)  # Tuple positions for input and output
         cntr = itertools.count()
-        w = self.tokenize_against_alphabet(word)
-        Q, output = [], []
-        heapq.heappush(Q, (0.0, 0, next(cntr), [], self.initialstate))  # (cost, -pos, output, state)
-        flag_filter = FlagStringFilter(self.alphabet) if obey_flags else None
+        index = self._alphabet_index()
+        if isinstance(word, (list, tuple)):
+            w = word
+        else:
+            w = _tokenize(index, word)
+        # Outputs are linked (previous, symbol) pairs so that pushing
+        # doesn't copy them; they are turned into lists when yielded
+        Q = []
+        heapq.heappush(Q, (0.0, 0, next(cntr), None, self.initialstate))  # (cost, -pos, output, state)
+        flag_filter = index.flag_filter
+        finalstates = self.finalstates
+        # Arcs of the states reached, by input symbol.  Indexed afresh
+        # on each call, as the FST may have been modified in between
+        arcindex = {}
+        # Input symbols that are followed without consuming the word
+        epsilons = [''] + list(flag_filter.flags)
+        # Input symbol to match at each position of the word: '.' if it
+        # is unknown, None if no arc can consume it
+        insyms = [sym if sym in self.alphabet else '.' for sym in w]
+        insyms = [None if sym in epsilons else sym for sym in insyms]
         
         while Q:
             cost, negpos, _, output, state = heapq.heappop(Q)
 
-            if state == None and -negpos == len(w) and (not obey_flags or flag_filter(output)):
+            if state == None and -negpos == len(w):
+                output = _unwind_output(output)
+                if obey_flags and not flag_filter(output):
+                    continue
                 if not print_flags:
                     output = FlagOp.filter_flags(output)
                 yield_output = ''.join(output) if not tokenize_outputs else output
@@ -559,86 +751,73 @@ class FST:
                 else:
                     yield (yield_output, cost)
             elif state != None:
-                if state in self.finalstates:
+                if state in finalstates:
                     heapq.heappush(Q, (cost + state.finalweight, negpos, next(cntr), output, None))
-                for lbl, t in state.all_transitions():
-                    if lbl[IN] == '' or FlagOp.is_flag(lbl[IN]):
-                        heapq.heappush(Q, (cost + t.weight, negpos, next(cntr), output + [lbl[OUT]], t.targetstate))
-                    elif -negpos < len(w):
-                        nextsym = w[-negpos] if w[-negpos] in self.alphabet else '.'
+                # Only look at the transitions whose input matches
+                arcs = arcindex.get(state)
+                if arcs is None:
+                    arcs = arcindex[state] = state._index_transitions(IN)
+                for sym in epsilons:
+                    for lbl, t in arcs.get(sym, ()):
+                        heapq.heappush(Q, (cost + t.weight, negpos, next(cntr), (output, lbl[OUT]), t.targetstate))
+                if -negpos < len(w):
+                    nextsym = insyms[-negpos]
+                    if nextsym is None:
+                        continue
+                    for lbl, t in arcs.get(nextsym, ()):
                         appendedsym = w[-negpos] if (nextsym == '.' and lbl[OUT] == '.') else lbl[OUT]
-                        if nextsym == lbl[IN]:
-                            heapq.heappush(Q, (
-                            cost + t.weight, negpos - 1, next(cntr), output + [appendedsym], t.targetstate))
+                        heapq.heappush(Q, (
+                        cost + t.weight, negpos - 1, next(cntr), (output, appendedsym), t.targetstate))
 
     def words(self: 'FST'):
         """A generator to yield all words. Yay BFS!"""
-        Q = deque([(self.initialstate, 0.0, [])])
+        # Paths are linked (previous, label) pairs so that queueing
+        # them is constant time, like the outputs in apply()
+        finalstates = self.finalstates
+        Q = deque([(self.initialstate, 0.0, None)])
         while Q:
             s, cost, seq = Q.popleft()
-            if s in self.finalstates:
-                yield cost + s.finalweight, seq
+            if s in finalstates:
+                yield cost + s.finalweight, _unwind_output(seq)
             for label, t in s.all_transitions():
-                Q.append((t.targetstate, cost + t.weight, seq + [label]))
+                Q.append((t.targetstate, cost + t.weight, (seq, label)))
 
     def tokenize_against_alphabet(self: 'FST', word) -> list:
         """Tokenize a string using the alphabet of the automaton."""
-        tokens = []
-        start = 0
-        while start < len(word):
-            t = word[start]  # Default is length 1 token unless we find a longer one
-            for length in range(1, len(word) - start + 1):  # TODO: limit to max length
-                if word[start:start + length] in self.alphabet:  # of syms in alphabet
-                    t = word[start:start + length]
-            tokens.append(t)
-            start += len(t)
-        return tokens
+        return list(_tokenize(self._alphabet_index(), word))
+
+    def _alphabet_index(self) -> _AlphabetIndex:
+        """Index of the alphabet, rebuilt only when self.alphabet is no
+        longer equal to the one it was built for."""
+        cached = getattr(self, '_alphabetcache', None)  # Not set by older pickles
+        if cached is None or cached[0] != self.alphabet:
+            frozen = frozenset(self.alphabet)
+            cached = self._alphabetcache = (frozen, _index_alphabet(frozen))
+        return cached[1]
 
     def todict(self) -> Dict[str, Any]:
         """Create a dictionary form of the FST for export to
         JSON.  May be post-processed for optimization in Javascript."""
-        # (re-)number all the states making sure the initial state is 0
-        # (the Javascript code depends on this, all other state numbers
-        # are arbitrary strings)
-        statenums = {id(self.initialstate): 0}
-        for s in self.states:
-            if s == self.initialstate:
-                continue
-            statenums[id(s)] = len(statenums)
-        # No need to hold out the initial state since it has number 0
-        transitions = {}
-        finals = {}
-        alphabet = {}
-        maxlen = 0
-        for s in self.states:
-            src = statenums[id(s)]
-            for label, arcs in s.transitions.items():
-                if len(label) == 1:
-                    isym = osym = label[0]
-                else:
-                    isym, osym = label
-                for sym in isym, osym:
-                    # Omit epsilon from symbol table
-                    if sym == "":
-                        continue
-                    if sym not in alphabet:
-                        # Reserve 0, 1, 2 for epsilon, identity,
-                        # unknown (actually not necessary)
-                        alphabet[sym] = 3 + len(alphabet)
-                        maxlen = max(maxlen, len(sym))
-                    sym = pyre.sub(r"\?|", r"\|", sym)
-                tlabel = isym if isym == osym else f"{isym}|{osym}"
-                # Nothing to do to the symbols beyond that as pyfoma
-                # already uses the same convention of epsilon='', and JSON
-                # encoding will take care of escaping everything for us
-                transitions.setdefault(src, {}).setdefault(tlabel, []).extend(
-                    # Ignore weights for now (but will support soon)
-                    statenums[id(arc.targetstate)] for arc in arcs
-                )
-            if s in self.finalstates:
-                finals[src] = 1
+        # The initial state is numbered 0 (the Javascript code depends
+        # on this, all other state numbers are arbitrary strings)
+        csr = _CSR(self)
+        # Omit epsilon from symbol table and reserve 0, 1, 2 for
+        # epsilon, identity, unknown (actually not necessary)
+        alphabet = {sym: 2 + idx for idx, sym in enumerate(csr.syms) if idx > 0}
+        # Nothing to do to the symbols beyond that as pyfoma already
+        # uses the same convention of epsilon='', and JSON encoding
+        # will take care of escaping everything for us
+        tlabels = [isym if isym == osym else f"{isym}|{osym}"
+                   for isym, osym in ((csr.syms[i], csr.syms[o])
+                                      for i, o in zip(csr.label_isym, csr.label_osym))]
+        transitions = defaultdict(lambda: defaultdict(list))
+        for src in range(len(csr.states)):
+            for arc in range(csr.indptr[src], csr.indptr[src + 1]):
+                # Ignore weights for now (but will support soon)
+                transitions[src][tlabels[csr.label[arc]]].append(csr.tgt[arc])
+        finals = {src: 1 for src, isfinal in enumerate(csr.final) if isfinal}
         return {
-            "transitions": transitions,
+            "transitions": {src: dict(out) for src, out in transitions.items()},
             "alphabet": alphabet,
             "finals": finals,
         }
@@ -647,30 +826,58 @@ class FST:
         """Create Javascript compatible with `foma_apply_down.js`"""
         fstdict = self.todict()
         # Optimize for foma_apply_down.js
-        transitions = {}
+        transitions = defaultdict(list)
+        labelsyms = {}  # Labels repeat across states, only split them once
         for src, out in fstdict["transitions"].items():
+            keys = {}  # Labels of a state often share an input symbol
             for label, arcs in out.items():
-                syms = pyre.split(r"(?<!\\)\|", label)
-                isym = syms[0]
-                osym = syms[-1]
-                transitions.setdefault(f"{src}|{isym}", []).extend(
-                    # NOTE: There is no reason for these to be
-                    # separate objects, but foma_apply_down.js wants
-                    # them that way.
-                    {arc: osym} for arc in arcs
-                )
+                if label not in labelsyms:
+                    syms = _LABEL_SPLIT_RE.split(label)
+                    labelsyms[label] = syms[0], syms[-1]
+                isym, osym = labelsyms[label]
+                if isym not in keys:
+                    keys[isym] = f"{src}|{isym}"
+                # NOTE: There is no reason for these to be
+                # separate objects, but foma_apply_down.js wants
+                # them that way.
+                transitions[keys[isym]].extend({arc: osym} for arc in arcs)
         # NOTE: in reality foma_apply_down.js only needs the *input*
         # symbols, so we could further optimize this.
-        fstdict["s"] = fstdict["alphabet"]
-        del fstdict["alphabet"]
-        fstdict["maxlen"] = max(len(k.encode('utf-16le'))
-                                for k in fstdict["s"]) // 2
-        fstdict["f"] = fstdict["finals"]
-        del fstdict["finals"]
-        fstdict["t"] = transitions
-        del fstdict["transitions"]
-        return " ".join(("var", jsnetname, "=",
-                         json.dumps(fstdict, ensure_ascii=False), ";"))
+        fstdict = {
+            "s": fstdict["alphabet"],
+            "maxlen": max(_utf16_len(k) for k in fstdict["alphabet"]),
+            "f": fstdict["finals"],
+            "t": transitions,
+        }
+        return f"var {jsnetname} = {_dumps_json(fstdict)};"
+
+    def tojs_binary(self, jsnetname: str = "myNet") -> str:
+        """Create Javascript with the transitions packed in a base64
+        string rather than spelled out as JSON objects.
+
+        The alphabet (`s`), `maxlen` and finals (`f`) are the same as
+        in `tojs`.  `l` lists the `[input, output]` symbols of each
+        label, and `d` holds (source, label, target) triples of
+        little-endian 32-bit integers, which can be unpacked with
+        `new Int32Array(Uint8Array.from(atob(myNet.d), c =>
+        c.charCodeAt(0)).buffer)`.
+        """
+        csr = _CSR(self)
+        data = array('i')
+        for src in range(len(csr.states)):
+            for arc in range(csr.indptr[src], csr.indptr[src + 1]):
+                data.extend((src, csr.label[arc], csr.tgt[arc]))
+        if sys.byteorder == "big":
+            data.byteswap()
+        alphabet = {sym: 2 + idx for idx, sym in enumerate(csr.syms) if idx > 0}
+        fstdict = {
+            "s": alphabet,
+            "maxlen": max((_utf16_len(k) for k in alphabet), default=0),
+            "f": {src: 1 for src, isfinal in enumerate(csr.final) if isfinal},
+            "l": [[csr.syms[i], csr.syms[o]] for i, o in zip(csr.label_isym, csr.label_osym)],
+            "d": base64.b64encode(data.tobytes()).decode("ascii"),
+        }
+        return f"var {jsnetname} = {_dumps_json(fstdict)};"
     # endregion
 
 
@@ -683,26 +890,37 @@ class Transition:
 
 
 class State:
+    __slots__ = ['transitions', '_transitionsin', '_transitionsout', 'finalweight', 'name']
     def __init__(self, finalweight = None, name = None):
-        __slots__ = ['transitions', '_transitionsin', '_transitionsout', 'finalweight', 'name']
         # Index both the first and last elements lazily (e.g. compose needs it)
         self.transitions = dict()     # (l_1,...,l_n):{transition1, transition2, ...}
-        self._transitionsin = None    # l_1:(label, transition1), (label, transition2), ... }
-        self._transitionsout = None   # l_n:(label, transition1), (label, transition2, ...)}
+        self._transitionsin = None    # l_1:[(label, transition1), (label, transition2), ...]
+        self._transitionsout = None   # l_n:[(label, transition1), (label, transition2), ...]
         if finalweight is None:
-            finalweight = float("inf")
+            finalweight = _INF
         self.finalweight = finalweight
         self.name = name
 
+    def __getstate__(self):
+        """Pickle a state, leaving out the transition indexes (which
+        are rebuilt when needed)."""
+        return {'transitions': self.transitions, 'finalweight': self.finalweight, 'name': self.name}
+
+    def __setstate__(self, state):
+        """Unpickle a state.  Those saved by older versions of pyfoma
+        have a __dict__, possibly with transition indexes in it."""
+        if isinstance(state, tuple):  # (__dict__, slots)
+            state = {**(state[0] or {}), **state[1]}
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self._transitionsin = self._transitionsout = None
+
     @property
     def transitionsin(self) -> dict:
         """Returns a dictionary of the transitions from a state, indexed by the input
            label, i.e. the first member of the label tuple."""
         if self._transitionsin is None:
-            self._transitionsin = defaultdict(set)
-            for label, newtrans in self.transitions.items():
-                for t in newtrans:
-                    self._transitionsin[label[0]] |= {(label, t)}
+            self._transitionsin = self._index_transitions(0)
         return self._transitionsin
 
     @property
@@ -710,32 +928,48 @@ class State:
         """Returns a dictionary of the transitions from a state, indexed by the output
            label, i.e. the last member of the label tuple."""
         if self._transitionsout is None:
-            self._transitionsout = defaultdict(set)
-            for label, newtrans in self.transitions.items():
-                for t in newtrans:
-                    self._transitionsout[label[-1]] |= {(label, t)}
+            self._transitionsout = self._index_transitions(-1)
         return self._transitionsout
 
+    def _index_transitions(self, pos) -> dict:
+        """Returns a new dictionary of (label, transition) pairs from a state,
+           indexed by the member pos of the label tuple."""
+        index = defaultdict(list)
+        for label, newtrans in self.transitions.items():
+            arcs = index[label[pos]]
+            for t in newtrans:
+                arcs.append((label, t))
+        return index
+
+    def _invalidate(self):
+        """Drop the lazily built transition indexes after a modification."""
+        self._transitionsin = self._transitionsout = None
+
     def rename_label(self, original, new):
         """Changes labels in a state's transitions from original to new."""
-        for t in self.transitions[original]:
+        self._invalidate()
+        transitions = self.transitions.pop(original)
+        for t in transitions:
             t.label = new
-        self.transitions[new] = self.transitions.get(new, set()) | self.transitions[original]
-        self.transitions.pop(original)
+        self.transitions.setdefault(new, set()).update(transitions)
 
     def remove_transitions_to_targets(self, targets):
         """Remove all transitions from self to any state in the set targets."""
-        newt = {}
+        self._invalidate()
+        empty = []
         for label, transitions in self.transitions.items():
-            newt[label] = {t for t in transitions if t.targetstate not in targets}
-            if len(newt[label]) == 0:
-                newt.pop(label)
-        self.transitions = newt
+            removed = [t for t in transitions if t.targetstate in targets]
+            if removed:  # Most labels are left alone
+                transitions.difference_update(removed)
+                if not transitions:
+                    empty.append(label)
+        for label in empty:
+            del self.transitions[label]
 
     def add_transition(self, other, label, weight):
         """Add transition from self to other with label and weight."""
-        newtrans = Transition(other, label, weight)
-        self.transitions[label] = self.transitions.get(label, set()) | {newtrans}
+        self._invalidate()
+        self.transitions.setdefault(label, set()).add(Transition(other, label, weight))
 
     def all_transitions(self):
         """Generator for all transitions out from a given state."""
@@ -749,17 +983,132 @@ class State:
 
     def all_epsilon_targets_cheapest(self) -> dict:
         """Returns a dict of states a state transitions to (cheapest) with epsilon."""
-        targets = defaultdict(lambda: float("inf"))
+        targets = {}
         for lbl, tr in self.transitions.items():
-            if all(len(sublabel) == 0 for sublabel in lbl): # funky epsilon-check
+            if lbl.count('') == len(lbl): # all sublabels are epsilon
                 for s in tr:
-                    targets[s.targetstate] = min(targets[s.targetstate], s.weight)
+                    w = s.weight  # <= so that infinite weights are kept too
+                    if w <= targets.get(s.targetstate, _INF):
+                        targets[s.targetstate] = w
         return targets
 
     def all_targets_cheapest(self) -> dict:
         """Returns a dict of states a state transitions to (cheapest)."""
-        targets = defaultdict(lambda: float("inf"))
+        targets = {}
         for tr in self.transitions.values():
             for s in tr:
-                targets[s.targetstate] = min(targets[s.targetstate], s.weight)
+                w = s.weight  # <= so that infinite weights are kept too
+                if w <= targets.get(s.targetstate, _INF):
+                    targets[s.targetstate] = w
         return targets
+
+
+def _state_classes(fst: FST, labelkey: Callable) -> dict:
+    """Number the states of an FST by color refinement, so that states
+    get the same number only if their final weights, and the labels,
+    weights and target numbers of their arcs, are all the same.  The
+    numbers depend only on the structure of the FST."""
+    classes = dict.fromkeys(fst.states, 0)
+    nclasses = 1
+    while True:
+        signatures = {s: (classes[s], s.finalweight,
+                          tuple(sorted((labelkey(label), t.weight, classes.get(t.targetstate, -1))
+                                       for label, t in s.all_transitions())))
+                      for s in fst.states}
+        numbers = {sig: i for i, sig in enumerate(sorted(set(signatures.values())))}
+        classes = {s: numbers[sig] for s, sig in signatures.items()}
+        if len(numbers) == nclasses:  # Refining any further changes nothing
+            return classes
+        nclasses = len(numbers)
+
+
+class _CSR:
+    """A read-only snapshot of an FST in compressed sparse row form.
+
+    States are numbered by their position in `states`, in breadth-first
+    order from the initial state (which is always 0) followed by any
+    unreachable states, and the arcs leaving state `i` are found,
+    sorted by label, weight and target, at positions `indptr[i]` to
+    `indptr[i + 1]` of the parallel arrays `tgt`, `label` and `weight`.
+    Labels are stored as indices into `labels`, and the first and last
+    symbols of each label in `label_isym` and `label_osym`, as indices
+    into `syms`, where the empty string (epsilon) is always 0.  The
+    snapshot is not updated if the FST is modified.
+
+    The order does not depend on that of sets, so it is the same for
+    equal FSTs.  Arcs with the same label and weight to states not yet
+    numbered are ordered by the structure of those states (see
+    _state_classes), which leaves only states that cannot be told
+    apart in an arbitrary order."""
+    __slots__ = ['states', 'indptr', 'tgt', 'label', 'weight',
+                 'labels', 'label_isym', 'label_osym', 'syms', 'final', 'finalweight']
+    def __init__(self, fst: FST):
+        self.states = [fst.initialstate]
+        statenums = {fst.initialstate: 0}
+        unreachable = None
+        classes = None  # Only needed for ties, see _state_classes
+        labelnums = {}
+        symnums = {'': 0}
+        self.labels = []
+        self.label_isym = array('i')
+        self.label_osym = array('i')
+        self.syms = ['']
+        self.indptr = array('i', [0])
+        self.tgt = array('i')
+        self.label = array('i')
+        self.weight = array('d')
+        sortkeys = {}  # Labels repeat across states, only make their keys once
+        def labelkey(label):
+            key = sortkeys.get(label)
+            if key is None:
+                key = sortkeys[label] = tuple(map(str, label))
+            return key
+        while True:
+            src = len(self.indptr) - 1
+            if src == len(self.states):
+                if unreachable is None:
+                    rest = [s for s in fst.states if s not in statenums]
+                    if rest:
+                        if classes is None:
+                            classes = _state_classes(fst, labelkey)
+                        rest.sort(key=classes.__getitem__)
+                    unreachable = (s for s in rest if s not in statenums)
+                s = next(unreachable, None)
+                if s is None:
+                    break
+                statenums[s] = src
+                self.states.append(s)
+            s = self.states[src]
+            # Labels may mix symbols and weights (see determinized_as_dfa)
+            for label in sorted(s.transitions, key=labelkey):
+                if label not in labelnums:
+                    labelnums[label] = len(self.labels)
+                    self.labels.append(label)
+                    for sym, syms in (label[0], self.label_isym), (label[-1], self.label_osym):
+                        if sym not in symnums:
+                            symnums[sym] = len(self.syms)
+                            self.syms.append(sym)
+                        syms.append(symnums[sym])
+                lbl = labelnums[label]
+                arcs = s.transitions[label]
+                # Weights are changed in place by the algorithms, so
+                # they are sorted every time, but most labels have one arc
+                if len(arcs) > 1:
+                    arcs = sorted(arcs, key=lambda t: t.weight)
+                    if any(a.weight == b.weight for a, b in zip(arcs, arcs[1:])):
+                        # Ties go to numbered states in order, then the others by class
+                        if classes is None:
+                            classes = _state_classes(fst, labelkey)
+                        arcs.sort(key=lambda t: (t.weight, statenums.get(t.targetstate, _INF),
+                                                 classes.get(t.targetstate, -1)))
+                for t in arcs:
+                    tgt = statenums.get(t.targetstate)
+                    if tgt is None:
+                        tgt = statenums[t.targetstate] = len(self.states)
+                        self.states.append(t.targetstate)
+                    self.tgt.append(tgt)
+                    self.label.append(lbl)
+                    self.weight.append(t.weight)
+            self.indptr.append(len(self.tgt))
+        self.final = bytearray(s in fst.finalstates for s in self.states)
+        self.finalweight = array('d', (s.finalweight for s in self.states))
@@ -1,11 +1,15 @@
+import base64
 import json
+import pickle
 import re
+import sys
 import unittest
+from array import array
 from collections import deque
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from pyfoma import algorithms
-from pyfoma.fst import FST
+from pyfoma.fst import FST, State, Transition, _TOKENIZE_CACHE_SIZE
 
 THISDIR = Path(__file__).parent
 
@@ -130,6 +134,30 @@ class TestFST(unittest.TestCase):
         f1.invert()
         self.assertEqual("cat", next(f1.generate("octopus")))
 
+    def test_modified_transitions(self):
+        """Verify that apply sees transitions added directly after a previous apply"""
+        f1 = FST.re("a")
+        self.assertEqual(["a"], list(f1.generate("a")))
+        s = f1.initialstate
+        target = next(iter(s.transitions[("a",)])).targetstate
+        self.assertEqual({0.0}, {t.weight for _, t in s.all_transitions()})
+        s.transitions[("b",)] = {Transition(target, ("b",), 0.0)}
+        f1.alphabet.add("b")
+        self.assertEqual(["b"], list(f1.generate("b")))
+        # Arcs replaced or added within the set of an existing label
+        s.transitions[("a",)] = {Transition(target, ("a",), 5.0)}
+        self.assertEqual([("a", 5.0)], list(f1.generate("a", weights=True)))
+        s.transitions[("a",)].add(Transition(target, ("a",), 2.0))
+        self.assertEqual([("a", 2.0), ("a", 5.0)], list(f1.generate("a", weights=True)))
+        self.assertEqual({0.0, 2.0, 5.0}, {t.weight for _, t in s.all_transitions()})
+        s.transitions = {}
+        self.assertEqual([], list(f1.generate("a")))
+        f2 = FST.re("a:b")
+        self.assertEqual([("b", 0.0)], list(f2.generate("a", weights=True)))
+        for t in next(iter(f2.initialstate.transitions.values())):
+            t.weight = 5.0
+        self.assertEqual([("b", 5.0)], list(f2.generate("a", weights=True)))
+
 
 class TestSymbols(unittest.TestCase):
     """Test multi-character symbol feature"""
@@ -156,6 +184,29 @@ class TestSymbols(unittest.TestCase):
         for word in words:
             self.assertEqual(word, next(lex.generate(word)))
 
+    def test_pretokenized(self):
+        """Verify that apply accepts already tokenized words"""
+        lex = FST.from_strings(["xu:x̌ʷ"], multichar_symbols=self.MULTICHAR_SYMBOLS)
+        tokens = lex.tokenize_against_alphabet("xu:x̌ʷ")
+        self.assertEqual(tokens, ["x", "u:", "x̌ʷ"])
+        self.assertEqual(["xu:x̌ʷ"], list(lex.generate(tokens)))
+        self.assertEqual(["xu:x̌ʷ"], list(lex.analyze(tuple(tokens))))
+
+    def test_tokenize_cache(self):
+        """Verify that remembered tokenizations are shared and bounded"""
+        lex = FST.from_strings(["hecho"], multichar_symbols=self.MULTICHAR_SYMBOLS)
+        for i in range(2 * _TOKENIZE_CACHE_SIZE):
+            self.assertEqual(["ch", *str(i)], lex.tokenize_against_alphabet(f"ch{i}"))
+        index = lex._alphabet_index()
+        self.assertLessEqual(len(index.tokenized), _TOKENIZE_CACHE_SIZE)
+        # One index per alphabet, even across FSTs
+        self.assertIs(index, lex._alphabet_index())
+        self.assertIs(index, lex.__copy__()._alphabet_index())
+        # Edits to the alphabet which keep its size
+        lex.alphabet.discard("o")
+        lex.alphabet.add("ec")
+        self.assertEqual(["h", "ec", "h"], lex.tokenize_against_alphabet("hech"))
+
     def test_quotes(self):
         """Make sure already-quoted things stay quoted correctly and we
         can pathologically escape quotes everywhere"""
@@ -236,6 +287,85 @@ class TestUtil(unittest.TestCase):
         att = str(self.fst)
         self.verify_att_format(att)
 
+    def test_to_str_canonical(self):
+        """Test that states and arcs are output in a canonical order."""
+        f1 = FST.re("$^rewrite((ab|ba|aba):x, leftmost = True)")
+        f2 = FST.re("$^rewrite((ab|ba|aba):x, leftmost = True)")
+        self.assertEqual(str(f1), str(f2))
+        self.assertEqual(str(f1), str(f1.__copy__()))
+        self.assertTrue(str(self.fst).startswith("0\t1\t[NO'UN]\t[NO'UN]\t"))
+
+    def test_to_str_canonical_nfa(self):
+        """Test that the order is canonical when arcs only differ by target."""
+        def branches(syms):
+            f = FST(alphabet={"a", *syms})
+            for sym in syms:
+                middle, final = State(), State(finalweight=0.0)
+                f.initialstate.add_transition(middle, ("a",), 0.0)
+                middle.add_transition(final, (sym,), 0.0)
+                f.states |= {middle, final}
+                f.finalstates.add(final)
+            unreachable = State()
+            unreachable.add_transition(middle, ("a",), 0.0)
+            f.states.add(unreachable)
+            return f
+        outputs = {(str(f), json.dumps(f.todict())) for f in (branches("bcdefg") for _ in range(20))}
+        self.assertEqual(1, len(outputs))
+
+    def test_save_load(self):
+        """Test saving and loading FSTs."""
+        with TemporaryDirectory() as tempdir:
+            path = str(Path(tempdir) / "test")
+            self.fst.save(path)
+            self.assertTrue(Path(path + ".fst").exists())
+            # Readable by all supported Python versions
+            self.assertEqual(b"\x80\x04", Path(path + ".fst").read_bytes()[:2])
+            f = FST.load(path)
+            self.assertEqual(str(self.fst), str(f))
+            self.assertEqual(self.fst.alphabet, f.alphabet)
+            self.assertEqual(set(self.fst.generate("[NO'UN][VERB]catROTFLMAO🤣")),
+                             set(f.generate("[NO'UN][VERB]catROTFLMAO🤣")))
+
+    def test_pickle(self):
+        """Test that pickled FSTs work and leave out their caches."""
+        f = FST.re("(cat):(dog) | a b*")
+        self.assertEqual(["dog"], list(f.generate("cat")))
+        self.assertTrue(f.initialstate.transitionsin)
+        f2 = pickle.loads(pickle.dumps(f))
+        self.assertFalse(hasattr(f2, "_alphabetcache"))
+        self.assertTrue(all(s._transitionsin is None for s in f2.states))
+        self.assertEqual(["dog"], list(f2.generate("cat")))
+        self.assertEqual(["abb"], list(f2.generate("abb")))
+
+    def test_regex_cache(self):
+        """Test that cached regular expressions are not shared."""
+        f1 = FST.re("(cat):(dog)")
+        f1.invert()
+        f2 = FST.re("(cat):(dog)")
+        self.assertEqual("cat", next(f1.generate("dog")))
+        self.assertEqual("dog", next(f2.generate("cat")))
+        a, b = FST.re("a"), FST.re("b")
+        with TemporaryDirectory() as tempdir:
+            FST.regex_cache_dir = tempdir
+            try:
+                f1 = FST.re("$X (cat):(dog)", {"X": a})
+                self.assertEqual(1, len(list(Path(tempdir).glob("*.fst"))))
+                f2 = FST.re("$X (cat):(dog)", {"X": a.__copy__()})
+                self.assertEqual(1, len(list(Path(tempdir).glob("*.fst"))))
+                self.assertEqual(str(f1), str(f2))
+                f3 = FST.re("$X (cat):(dog)", {"X": b})
+                self.assertEqual("bdog", next(f3.generate("bcat")))
+                self.assertEqual(2, len(list(Path(tempdir).glob("*.fst"))))
+                # Damaged files are compiled and saved again
+                for path in Path(tempdir).glob("*.fst"):
+                    path.write_bytes(path.read_bytes()[:20])
+                f4 = FST.re("$X (cat):(dog)", {"X": b})
+                self.assertEqual(str(f3), str(f4))
+                self.assertEqual(2, len(list(Path(tempdir).glob("*.fst"))))
+                self.assertEqual(str(f3), str(FST.re("$X (cat):(dog)", {"X": b})))
+            finally:
+                FST.regex_cache_dir = None
+
     def test_to_att(self):
         """Test more complete AT&T format conversion."""
         with TemporaryDirectory() as tempdir:
@@ -259,6 +389,11 @@ class TestUtil(unittest.TestCase):
                 #      --osymbols=test.osyms --keep_isymbols \
                 #      --keep_osymbols --keep_state_numbering \
                 #      test.att  | fstprint
+            # Weights follow the labels (and are left out when zero)
+            f = FST.re("a:b<1.5> c<0.5>")
+            f.save_att(path / "test_w.att")
+            with open(path / "test_w.att", "rt") as infh:
+                self.assertEqual("0\t1\ta\tb\t2.0\n1\t2\tc\tc\n2\n", infh.read())
             # Check state symbols get output too
             f = FST.rlg({"Root": [("", "Sublex")],
                          "Sublex": [(("foo", "bar"), "#")]}, "Root")
@@ -278,14 +413,35 @@ class TestUtil(unittest.TestCase):
                 #      --keep_osymbols --keep_state_numbering \
                 #      test_st.fst | fstprint
 
+    def test_to_js_binary(self):
+        """Verify that the packed transitions are the same FST"""
+        d = self.fst.todict()
+        js = self.fst.tojs_binary()
+        js_json = json.loads(re.sub(r"^var \w+ = (.*);", r"\1", js))
+        self.assertEqual(d["alphabet"], js_json["s"])
+        self.assertEqual(10, js_json["maxlen"])
+        self.assertEqual([str(src) for src in d["finals"]], list(js_json["f"]))
+        data = array("i", base64.b64decode(js_json["d"]))
+        if sys.byteorder == "big":
+            data.byteswap()
+        transitions = {}
+        for src, label, tgt in zip(data[0::3], data[1::3], data[2::3]):
+            isym, osym = js_json["l"][label]
+            label = isym if isym == osym else f"{isym}|{osym}"
+            transitions.setdefault(src, {}).setdefault(label, []).append(tgt)
+        self.assertEqual(d["transitions"], transitions)
+        # No symbols at all
+        js_json = json.loads(re.sub(r"^var \w+ = (.*);", r"\1", FST.re("''").tojs_binary()))
+        self.assertEqual(({}, 0, {"0": 1}, ""), (js_json["s"], js_json["maxlen"], js_json["f"], js_json["d"]))
+
     def test_to_js_on(self):
         # Has no maxlen anymore, downstream code should do that
         d = self.fst.todict()
         self.assertIn(0, d["transitions"])
         self.assertEqual(1, len(d["finals"]))
         js = self.fst.tojs()
-        self.assertIn('"maxlen": 10', js)
-        self.assertIn(""""0|[NO'UN]": [{""", js)
+        self.assertIn('"maxlen":10', js)
+        self.assertIn(""""0|[NO'UN]":[{""", js)
         # Ensure the JavaScript is the same FST
         js_dict = re.sub(r"^var \w+ = (.*);", r"\1", js)
         js_json = json.loads(js_dict)